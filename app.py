@@ -1,192 +1,812 @@
 import os
+import hmac
+import hashlib
+import time
+import random
+import shutil
+import queue
 import logging
+from logging.handlers import QueueHandler, QueueListener
 import tempfile
+import threading
+import subprocess
+import types
+import uuid
+import copy
+import http.client
+import concurrent.futures
+from urllib.parse import urlsplit, parse_qs
+import httpx
+import orjson
 import requests
-from flask import Flask, request, jsonify
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import Flask, request
 import yt_dlp
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Configure logging. Records go onto an unbounded queue and a single
+# background thread does the formatting and stdout flushing, so request
+# and job threads never serialize on the stream handler's lock or block
+# on a slow write to the log pipe.
+_LOG_QUEUE = queue.Queue(-1)
+_LOG_STREAM = logging.StreamHandler()
+_LOG_STREAM.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s %(message)s'))
+# The queue handler must pass records through verbatim - QueueHandler's
+# prepare() bakes its formatter into record.msg, and basicConfig would
+# give it the default level:name:message one, double-formatting every
+# line. Only the listener-side formatter shapes output.
+_LOG_HANDLER = QueueHandler(_LOG_QUEUE)
+_LOG_HANDLER.setFormatter(logging.Formatter('%(message)s'))
+logging.basicConfig(level=logging.INFO, handlers=[_LOG_HANDLER])
+_LOG_LISTENER = QueueListener(_LOG_QUEUE, _LOG_STREAM, respect_handler_level=True)
+_LOG_LISTENER.start()
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
+def _json_response(payload, status=200):
+    # orjson is several times faster than the stdlib encoder flask uses
+    return app.response_class(orjson.dumps(payload), status=status, mimetype='application/json')
+
+# Shared HTTP session so uploads and callbacks reuse pooled keep-alive
+# connections instead of paying a TCP+TLS handshake per call. Transient
+# 5xx/429 from Supabase or the callback host are retried with exponential
+# backoff instead of re-downloading the media from scratch.
+_RETRIES = Retry(
+    total=5,
+    backoff_factor=1.0,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=['GET', 'PUT', 'POST'],
+    respect_retry_after_header=True,
+)
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=_RETRIES))
+SESSION.mount('http://', HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=_RETRIES))
+
+# HTTP/2 client for the large storage uploads - Supabase's CDN speaks h2, so
+# concurrent PUTs multiplex over one TLS connection instead of each paying
+# their own handshake
+HTTPX = httpx.Client(
+    http2=True,
+    # Generous read/write for multi-hundred-MB PUT bodies; connect and
+    # pool-acquire stay tight so a dead edge node fails fast
+    timeout=httpx.Timeout(connect=10.0, read=120.0, write=120.0, pool=5.0),
+    limits=httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=60.0),
+)
+
 # Configuration
 API_SECRET = os.environ.get('API_SECRET', 'your-secret-key')
+# Service key for the TUS resumable-upload path (optional)
+SUPABASE_KEY = os.environ.get('SUPABASE_KEY')
+# Files above this go through TUS so an upload failure resumes, not restarts
+RESUMABLE_THRESHOLD = int(os.environ.get('RESUMABLE_THRESHOLD', str(50 * 1024 * 1024)))
+# Optional egress proxy, user:pass@host:port - see _proxy_with_session
+PROXY_URL = os.environ.get('PROXY_URL')
+# Asset caps, enforced after the metadata probe but before any media
+# bytes move - bandwidth (and proxy traffic) is the paid resource here.
+# 0 disables a cap.
+MAX_DURATION_SECONDS = int(os.environ.get('MAX_DURATION_SECONDS', '0'))
+MAX_FILESIZE_BYTES = int(os.environ.get('MAX_FILESIZE_BYTES', '0'))
+
+# ffmpeg backs every postprocessor; probe it once at boot so a missing binary
+# fails loudly here instead of minutes into the first job, and so the binary
+# and its codec tables are already warm in the page cache when yt-dlp forks it
+try:
+    subprocess.run(['ffmpeg', '-version'], capture_output=True, check=True)
+    logger.info("✅ ffmpeg available")
+except (OSError, subprocess.CalledProcessError):
+    logger.warning("⚠️ ffmpeg not found - audio/video postprocessing will fail")
+
+# Scratch space: prefer tmpfs so downloaded media never touches disk - each
+# file is written once, read once for the upload, then deleted. Only picked
+# when /dev/shm has real headroom so we don't trade disk I/O for an OOM kill.
+if os.path.isdir('/dev/shm') and shutil.disk_usage('/dev/shm').free > 2 * 1024 ** 3:
+    TMPDIR = '/dev/shm'
+else:
+    TMPDIR = tempfile.gettempdir()
+
+# Worker pool for download jobs - the handler returns 202 immediately and the
+# caller learns the outcome via the callback_url, so concurrency is
+# workers x DL_WORKERS instead of one job per HTTP worker
+EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=int(os.environ.get('DL_WORKERS', '4')),
+    thread_name_prefix='dl',
+)
+
+# Separate pool for the upload stage: download (network-in), ffmpeg (CPU) and
+# upload (network-out) use disjoint resources, so while job A's file is going
+# to storage a download worker can already be fetching job B
+UPLOAD_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=int(os.environ.get('UPLOAD_WORKERS', '4')),
+    thread_name_prefix='ul',
+)
+
+# Callbacks are pure signalling - nobody consumes the response - so they're
+# fired from a small dedicated pool instead of holding a job worker for up
+# to 30s of POST latency; the shared session's retry policy still applies
+CALLBACK_POOL = concurrent.futures.ThreadPoolExecutor(
+    max_workers=8,
+    thread_name_prefix='cb',
+)
+
+# Admission control: every in-flight job can hold a large temp file plus an
+# ffmpeg subprocess, so shed load with a fast 429 instead of queueing
+# unboundedly until the container OOMs
+INFLIGHT = threading.BoundedSemaphore(int(os.environ.get('MAX_INFLIGHT', '4')))
+
+# yt-dlp options are built once here; each job shallow-copies the base and
+# overrides only its per-request fields (outtmpl and the media-type branch).
+# CRITICAL: Use format that works with ios client.
+_BASE_YDL_OPTS = {
+    'quiet': False,
+    'no_warnings': False,
+    'extract_flat': False,
+    'nocheckcertificate': True,
+    'ignoreerrors': False,
+    'no_color': True,
+    'geo_bypass': True,
+    # Fetch HLS/DASH fragments in parallel and use large ranged GETs -
+    # the ios/mweb clients mostly serve fragmented streams
+    'concurrent_fragment_downloads': int(os.environ.get('YTDL_CONCURRENT_FRAGMENTS', '8')),
+    'http_chunk_size': 10 * 1024 * 1024,
+    # Write downloaded data in 1MB blocks instead of the 1KB default -
+    # a 300MB file becomes ~300 write syscalls instead of ~300k
+    'buffersize': 1024 * 1024,
+    # A single bad fragment shouldn't abort a download that's 95% done
+    'fragment_retries': 10,
+    # No mandatory sleep on the happy path; when a request does fail, back
+    # off exponentially with jitter (capped) instead of a fixed nap. The
+    # jitter decorrelates concurrent jobs so their retries don't land on
+    # YouTube in lockstep.
+    'sleep_interval': 0,
+    'max_sleep_interval': 0,
+    'sleep_interval_requests': 0,
+    'retry_sleep_functions': {
+        'http': lambda n: min(30.0, random.uniform(0.5, 0.5 * 2 ** n)),
+        'fragment': lambda n: min(10.0, random.uniform(0.25, 0.25 * 2 ** n)),
+        'extractor': lambda n: min(60.0, random.uniform(1.0, 2.0 ** n)),
+    },
+    # One client only: each extra entry costs another signed Innertube
+    # round trip per video even when the first one succeeded. The download
+    # path retries once with mweb added when ios alone fails.
+    'extractor_args': {
+        'youtube': {
+            'player_client': ['ios'],
+            'player_skip': ['webpage', 'configs'],
+        }
+    },
+    # Headers to appear as mobile device
+    'http_headers': {
+        'User-Agent': 'com.google.ios.youtube/19.29.1 (iPhone16,2; U; CPU iOS 17_5_1 like Mac OS X;)',
+        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+        'Accept-Language': 'en-US,en;q=0.5',
+    },
+}
+
+# aria2c fetches HLS/DASH fragments over 16 parallel connections, which
+# typically multiplies download throughput on the fragmented streams the
+# ios/mweb clients return; plain http(s) downloads stay on the native
+# downloader, which handles the ranged 10MB chunking and resume logic
+if os.environ.get('YTDL_USE_ARIA2C', '1') != '0' and shutil.which('aria2c'):
+    _BASE_YDL_OPTS.update({
+        'external_downloader': {'default': 'native', 'm3u8': 'aria2c', 'dash': 'aria2c'},
+        'external_downloader_args': {
+            'aria2c': ['-x', '16', '-s', '16', '-k', '1M', '--summary-interval=0', '--console-log-level=warn'],
+        },
+    })
+
+def _freeze(value):
+    """Recursively wrap dicts in read-only mapping proxies."""
+    if isinstance(value, dict):
+        return types.MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    return value
+
+# Freeze the template now that it's fully built. Jobs always work on a
+# mutable .copy() of the top level, but that copy shares the nested
+# dicts (http_headers, extractor_args, ...) with every other job, so
+# those are the layers that must be read-only for a stray write to blow
+# up at the write site instead of corrupting later downloads.
+# MappingProxyType.copy() hands back a plain mutable dict, so the
+# per-job copy-and-override pattern is unchanged.
+_BASE_YDL_OPTS = _freeze(_BASE_YDL_OPTS)
+
+# For audio: prefer an AAC/m4a stream and ship it untouched. AAC plays
+# everywhere m4a does, so the mp3 re-encode - an ffmpeg pass costing real
+# CPU per minute of audio - buys nothing on this path.
+_AUDIO_YDL_OPTS = {
+    'format': 'bestaudio[ext=m4a]/bestaudio[acodec^=mp4a]/bestaudio',
+}
+
+# For callers that truly need mp3 (type 'audio-mp3'): the old re-encode
+# pipeline. Sources that are already mp3 pass through without a
+# re-encode; for the rest, -threads 0 lets ffmpeg use every core for the
+# decode/filter side of the pipeline. preferredquality values under 10
+# mean lame VBR -q:a: level 2 averages ~190kbps but scales down with the
+# source instead of padding low-bitrate Opus up to a fixed 192kbps CBR.
+_AUDIO_MP3_YDL_OPTS = {
+    'format': 'bestaudio/best',
+    'postprocessors': [{
+        'key': 'FFmpegExtractAudio',
+        'preferredcodec': 'mp3',
+        'preferredquality': '2',
+        'nopostoverwrites': False,
+    }],
+    'postprocessor_args': {'extractaudio': ['-threads', '0']},
+}
+
+# For video: prefer h264+aac streams, which merge into mp4 with a pure
+# stream copy - the Merger never re-encodes - and +faststart moves the
+# moov atom up front so playback can start before the whole file is fetched.
+# No convertor postprocessor: the format selection already lands in mp4, so
+# a second ffmpeg pass over the merged file would be pure waste.
+_VIDEO_YDL_OPTS = {
+    'format': 'bestvideo[vcodec^=avc1]+bestaudio[acodec^=mp4a]/best',
+    'merge_output_format': 'mp4',
+    'postprocessor_args': {'merger': ['-c', 'copy', '-movflags', '+faststart']},
+}
+
+REQUIRED_FIELDS = frozenset(['url', 'type', 'asset_id', 'artist_id', 'secret', 'callback_url'])
+
+# Legitimate request bodies are a few hundred bytes of JSON; anything
+# bigger is rejected before it gets buffered or parsed
+_MAX_BODY_BYTES = 4096
+
+# Fallback Content-Type when the caller doesn't send one, keyed by the
+# extension of the file that actually came out of yt-dlp - guessing from
+# the media type produced wrong headers (audio/m4a, video/mkv) that
+# browsers then have to sniff and CDNs cache incorrectly
+_MIME_BY_EXT = {
+    '.mp3': 'audio/mpeg',
+    '.m4a': 'audio/mp4',
+    '.aac': 'audio/aac',
+    '.ogg': 'audio/ogg',
+    '.opus': 'audio/opus',
+    '.wav': 'audio/wav',
+    '.mp4': 'video/mp4',
+    '.webm': 'video/webm',
+    '.mkv': 'video/x-matroska',
+}
+
+# TTL cache for /info lookups - UIs poll the same URL repeatedly, and every
+# miss costs a full yt-dlp extraction round trip to YouTube
+INFO_CACHE = {}
+INFO_CACHE_LOCK = threading.Lock()
+INFO_CACHE_TTL = int(os.environ.get('INFO_CACHE_TTL', '600'))
+INFO_CACHE_MAX = 4096
+
+# Extractor results for /download jobs, keyed like the /info cache. A
+# retry of the same asset (say, after an upload failure) reuses the
+# processed info dict and skips the Innertube handshake and signature
+# work entirely; YouTube format URLs stay valid for ~6 hours, far past
+# this TTL. No external store - retries land on the same container.
+DL_INFO_CACHE = {}
+DL_INFO_CACHE_LOCK = threading.Lock()
+DL_INFO_CACHE_TTL = int(os.environ.get('DL_INFO_CACHE_TTL', '1800'))
+DL_INFO_CACHE_MAX = 256
+
+# One long-lived YoutubeDL for /info: constructing an instance re-registers
+# extractors and rebuilds the HTTP opener every call (tens of ms), and /info
+# takes no per-request options so a single instance can serve every lookup.
+# Built at import so workers pay the cost at boot, not on the first request.
+# YoutubeDL isn't thread-safe, hence the lock. /download keeps per-request
+# instances because outtmpl differs per job and jobs run concurrently.
+_INFO_YDL = yt_dlp.YoutubeDL({
+    'quiet': True,
+    'no_warnings': True,
+    'skip_download': True,
+    'nocheckcertificate': True,
+    'no_color': True,
+    # /info only returns title/duration/etc, so skip the parts of extraction
+    # that exist to produce playable format URLs: the DASH/HLS manifests and
+    # the JS player needed for signature solving
+    'youtube_include_dash_manifest': False,
+    'youtube_include_hls_manifest': False,
+    'extractor_args': {
+        'youtube': {
+            'player_client': ['ios'],
+            'player_skip': ['webpage', 'configs', 'js'],
+        }
+    },
+})
+_INFO_YDL_LOCK = threading.Lock()
+
+def _normalize_info_url(url):
+    """Collapse equivalent YouTube URLs onto one /info cache key.
+
+    watch?v=, youtu.be/, shorts/ and embed/ forms of the same video (plus
+    tracking params) all resolve to the same metadata, so key the cache by
+    video id where one can be found and by the raw URL otherwise.
+    """
+    parts = urlsplit(url)
+    host = parts.netloc.lower()
+    host = host[4:] if host.startswith('www.') else host
+    host = host[2:] if host.startswith('m.') else host
+    video_id = ''
+    if host == 'youtu.be':
+        video_id = parts.path.lstrip('/').split('/')[0]
+    elif host.endswith('youtube.com'):
+        if parts.path == '/watch':
+            video_id = parse_qs(parts.query).get('v', [''])[0]
+        elif parts.path.startswith(('/shorts/', '/embed/', '/live/')):
+            segments = parts.path.split('/')
+            video_id = segments[2] if len(segments) > 2 else ''
+    return f'yt:{video_id}' if video_id else url
+
+def _proxy_with_session(proxy_url):
+    """Return proxy_url with a fresh per-download session id.
+
+    Rotating proxy providers key the egress IP off the username, so
+    rewriting user:pass@host:port to user-session-<id>:pass@host:port
+    gives each download its own exit IP. Without this every job shares
+    one IP, and once YouTube throttles it every later download pays the
+    429-backoff tax too.
+    """
+    parts = urlsplit(proxy_url if '//' in proxy_url else f'http://{proxy_url}')
+    if not parts.username or not parts.password:
+        return proxy_url
+    netloc = f"{parts.username}-session-{uuid.uuid4().hex[:12]}:{parts.password}@{parts.hostname}"
+    if parts.port:
+        netloc += f":{parts.port}"
+    return parts._replace(netloc=netloc).geturl()
+
+def _read_json_body():
+    """Parse the request body as a JSON object, enforcing the size cap.
+
+    Returns (data, None) on success, (None, response) on rejection.
+    Content-Length is checked first so oversized bodies are refused
+    before being buffered, but it's absent on chunked uploads, so the
+    buffered length is capped as well. Valid JSON that isn't an object
+    ([1,2,3], "x") is rejected like unparseable input - the handlers
+    index into a dict.
+    """
+    if (request.content_length or 0) > _MAX_BODY_BYTES:
+        return None, _json_response({"error": "Payload too large"}, 413)
+    body = request.get_data(cache=False)
+    if len(body) > _MAX_BODY_BYTES:
+        return None, _json_response({"error": "Payload too large"}, 413)
+    try:
+        data = orjson.loads(body)
+    except orjson.JSONDecodeError:
+        data = None
+    if not isinstance(data, dict):
+        return None, _json_response({"error": "Invalid JSON body"}, 400)
+    return data, None
+
+def _check_secret(secret):
+    # Constant-time comparison so the check can't leak the secret byte by byte
+    return bool(secret) and isinstance(secret, str) and hmac.compare_digest(secret, API_SECRET)
+
+def _public_url_from_signed(upload_url):
+    """Derive the public object URL from a signed Supabase upload URL.
+
+    Signed upload URLs look like
+    .../storage/v1/object/upload/sign/<bucket>/<path>?token=... and the
+    public URL schema for public buckets is stable, so it can be built
+    locally instead of asking Supabase for it.
+    """
+    parts = urlsplit(upload_url)
+    marker = '/storage/v1/object/upload/sign/'
+    if marker not in parts.path:
+        return None
+    bucket_and_path = parts.path.split(marker, 1)[1]
+    return f"{parts.scheme}://{parts.netloc}/storage/v1/object/public/{bucket_and_path}"
+
+def _upload_resumable(upload_url, path, size, content_type):
+    """Upload a large file through Supabase's TUS endpoint, in 6MB parts.
+
+    A network blip mid-PUT forces a full restart of the transfer; TUS
+    resumes from the last acknowledged chunk instead. Needs SUPABASE_KEY
+    plus a signed upload URL to derive bucket/object from. Returns a
+    (status_code, text) pair like _put_file, or None when resumable
+    upload isn't available so the caller can fall back to the single PUT.
+    """
+    if not SUPABASE_KEY:
+        return None
+    try:
+        from tusclient import client as tus
+    except ImportError:
+        return None
+
+    parts = urlsplit(upload_url)
+    marker = '/storage/v1/object/upload/sign/'
+    if marker not in parts.path:
+        return None
+    bucket, _, object_path = parts.path.split(marker, 1)[1].partition('/')
+
+    try:
+        tus_client = tus.TusClient(
+            f"{parts.scheme}://{parts.netloc}/storage/v1/upload/resumable",
+            headers={'Authorization': f'Bearer {SUPABASE_KEY}', 'x-upsert': 'true'},
+        )
+        uploader = tus_client.uploader(
+            path,
+            chunk_size=6 * 1024 * 1024,
+            metadata={
+                'bucketName': bucket,
+                'objectName': object_path,
+                'contentType': content_type,
+            },
+        )
+        uploader.upload()
+        return 200, ''
+    except Exception as e:
+        logger.warning(f"⚠️ Resumable upload failed, falling back to single PUT: {e}")
+        return None
+
+class _HashingReader:
+    """Iterable wrapper that hashes bytes as the HTTP client sends them.
+
+    httpx takes request bodies as byte iterables (a bare .read() object is
+    rejected), so the file is yielded in fixed-size chunks and the digest
+    piggybacks on that one sequential pass - no extra read of the data.
+    The preset Content-Length header keeps the PUT un-chunked. blake2b is
+    ~3x faster than md5 on x86-64 for this.
+    """
+
+    _CHUNK = 1024 * 1024
+
+    def __init__(self, f):
+        self._f = f
+        self.digest = hashlib.blake2b(digest_size=16)
+
+    def __iter__(self):
+        while True:
+            chunk = self._f.read(self._CHUNK)
+            if not chunk:
+                return
+            self.digest.update(chunk)
+            yield chunk
+
+def _put_file(upload_url, path, size, content_type):
+    """PUT a local file to upload_url, returning (status_code, response_text).
+
+    Plain-http targets (e.g. an internal upload sidecar) get a zero-copy
+    os.sendfile straight from the file to the socket; TLS targets can't
+    sendfile, so they stream through the pooled HTTP/2 client in
+    fixed-size chunks with Content-Length preset from the known size.
+    """
+    parts = urlsplit(upload_url)
+    if parts.scheme == 'http':
+        conn = http.client.HTTPConnection(parts.netloc, timeout=300)
+        try:
+            try:
+                target = parts.path + (f'?{parts.query}' if parts.query else '')
+                conn.putrequest('PUT', target)
+                conn.putheader('Content-Type', content_type)
+                conn.putheader('Content-Length', str(size))
+                conn.endheaders()
+                with open(path, 'rb') as f:
+                    offset = 0
+                    while offset < size:
+                        sent = os.sendfile(conn.sock.fileno(), f.fileno(), offset, size - offset)
+                        if sent == 0:
+                            break
+                        offset += sent
+                response = conn.getresponse()
+                return response.status, response.read().decode('utf-8', 'replace')
+            except OSError as e:
+                # Some transports refuse sendfile (and the request may have
+                # died mid-stream); the streamed PUT below covers them
+                logger.warning(f"⚠️ sendfile upload failed, using streamed PUT: {e}")
+        finally:
+            conn.close()
+
+    # Stream the file handle over the shared HTTP/2 client; set Content-Length
+    # up front so the PUT isn't chunked. buffering=0 hands httpx the raw
+    # FileIO, so each socket write reads straight from the page cache instead
+    # of bouncing through a BufferedReader. httpx doesn't retry on status, so
+    # transient storage errors are retried here with a fresh handle.
+    for attempt in range(4):
+        with open(path, 'rb', buffering=0) as f:
+            reader = _HashingReader(f)
+            response = HTTPX.put(
+                upload_url,
+                content=reader,
+                headers={
+                    'Content-Type': content_type,
+                    'Content-Length': str(size),
+                }
+            )
+        if response.status_code not in (429, 500, 502, 503, 504) or attempt == 3:
+            logger.info(f"🔐 Uploaded {size} bytes, blake2b {reader.digest.hexdigest()}")
+            return response.status_code, response.text
+        time.sleep(min(30, 2 ** attempt * (0.5 + random.random())))
+
+def _extract_with_backoff(ydl, url, download):
+    """Run extract_info, backing off with jitter when YouTube rate-limits us."""
+    max_attempts = 3
+    for attempt in range(max_attempts):
+        try:
+            return ydl.extract_info(url, download=download)
+        except yt_dlp.utils.DownloadError as e:
+            if attempt + 1 >= max_attempts or 'HTTP Error 429' not in str(e):
+                raise
+            delay = min(30, 2 ** attempt * (0.5 + random.random()))
+            logger.warning(f"⏳ Rate limited, retrying in {delay:.1f}s: {url}")
+            time.sleep(delay)
 
 @app.route('/health', methods=['GET'])
 def health_check():
-    return jsonify({"status": "healthy", "service": "yt-dlp-downloader"})
+    return _json_response({"status": "healthy", "service": "yt-dlp-downloader"})
+
+@app.route('/info', methods=['POST'])
+def get_info():
+    data, error = _read_json_body()
+    if error is not None:
+        return error
+
+    if not _check_secret(data.get('secret')):
+        return _json_response({"error": "Invalid secret"}, 401)
+
+    if 'url' not in data:
+        return _json_response({"error": "Missing required field: url"}, 400)
+
+    url = data['url']
+    cache_key = _normalize_info_url(url)
+    now = time.monotonic()
+
+    with INFO_CACHE_LOCK:
+        cached = INFO_CACHE.get(cache_key)
+        if cached and cached[0] > now:
+            return _json_response(cached[1])
+
+    try:
+        with _INFO_YDL_LOCK:
+            info = _extract_with_backoff(_INFO_YDL, url, download=False)
+
+        if info is None:
+            raise Exception("Failed to extract video info")
+
+        payload = {
+            'video_id': info.get('id'),
+            'title': info.get('title'),
+            'duration': info.get('duration'),
+            'uploader': info.get('uploader'),
+            'thumbnail': info.get('thumbnail'),
+        }
+    except Exception as e:
+        logger.error(f"❌ Info error: {e}")
+        return _json_response({"error": str(e)}, 500)
+
+    # Only cache successful lookups
+    with INFO_CACHE_LOCK:
+        if len(INFO_CACHE) >= INFO_CACHE_MAX:
+            INFO_CACHE.clear()
+        INFO_CACHE[cache_key] = (now + INFO_CACHE_TTL, payload)
+
+    return _json_response(payload)
 
 @app.route('/download', methods=['POST'])
 def download_media():
+    data, error = _read_json_body()
+    if error is not None:
+        return error
+
+    # Auth first: unauthorized callers get the shortest possible path and
+    # learn nothing about which fields the endpoint expects
+    if not _check_secret(data.get('secret')):
+        return _json_response({"error": "Invalid secret"}, 401)
+
+    # Validate required fields, reporting every missing one at once
+    missing = REQUIRED_FIELDS - data.keys()
+    if missing:
+        return _json_response({"error": f"Missing required fields: {', '.join(sorted(missing))}"}, 400)
+
+    if not INFLIGHT.acquire(blocking=False):
+        response = _json_response({"error": "Too many downloads in flight"}, 429)
+        response.headers['Retry-After'] = '30'
+        return response
+
+    # The INFLIGHT slot is released by the job itself once its last stage
+    # (the upload handoff) finishes
+    EXECUTOR.submit(_do_download, data)
+    return _json_response({"accepted": True, "status": "queued", "asset_id": data['asset_id']}, 202)
+
+def _post_callback(url, payload):
+    try:
+        response = SESSION.post(
+            url,
+            data=orjson.dumps(payload),
+            headers={'Content-Type': 'application/json'},
+            timeout=30,
+        )
+        logger.info(f"✅ Callback response: {response.status_code}")
+    except Exception as callback_error:
+        logger.error(f"❌ Callback error: {callback_error}")
+
+def _send_callback(url, payload):
+    logger.info(f"📞 Sending callback to: {url}")
+    CALLBACK_POOL.submit(_post_callback, url, payload)
+
+def _send_failure(data, error_msg):
+    _send_callback(data['callback_url'], {
+        'asset_id': data['asset_id'],
+        'status': 'failed',
+        'error_message': error_msg,
+        'secret': data.get('secret', ''),
+    })
+
+def _do_download(data):
+    """Download stage: fetch the media, then hand the file to the upload
+    stage so this worker can start on the next queued job while the bytes
+    go to storage."""
+    handed_off = False
     try:
-        data = request.get_json()
-        
-        # Validate required fields
-        required_fields = ['url', 'type', 'asset_id', 'artist_id', 'secret', 'callback_url']
-        for field in required_fields:
-            if field not in data:
-                return jsonify({"error": f"Missing required field: {field}"}), 400
-        
-        # Validate secret
-        if data['secret'] != API_SECRET:
-            return jsonify({"error": "Invalid secret"}), 401
-        
         url = data['url']
-        media_type = data['type']  # 'audio' or 'video'
-        asset_id = data['asset_id']
-        callback_url = data['callback_url']
-        upload_url = data.get('upload_url')
-        public_url = data.get('public_url')
-        content_type = data.get('content_type', 'video/mp4')
-        
+        media_type = data['type']  # 'audio', 'audio-mp3' or 'video'
+
         logger.info(f"📥 Starting download: {url} as {media_type}")
-        
-        # Create temp directory for download
-        with tempfile.TemporaryDirectory() as temp_dir:
+
+        # Created without a context manager: ownership passes to the upload
+        # stage, which removes it when the file has been shipped
+        temp_dir = tempfile.mkdtemp(dir=TMPDIR)
+        try:
             output_template = os.path.join(temp_dir, '%(id)s.%(ext)s')
-            
-            # Configure yt-dlp options - CRITICAL: Use format that works with ios client
-            ydl_opts = {
-                'outtmpl': output_template,
-                'quiet': False,
-                'no_warnings': False,
-                'extract_flat': False,
-                'nocheckcertificate': True,
-                'ignoreerrors': False,
-                'no_color': True,
-                'geo_bypass': True,
-                'extractor_args': {
-                    'youtube': {
-                        'player_client': ['ios', 'mweb'],
-                        'player_skip': ['webpage', 'configs'],
-                    }
-                },
-                # Headers to appear as mobile device
-                'http_headers': {
-                    'User-Agent': 'com.google.ios.youtube/19.29.1 (iPhone16,2; U; CPU iOS 17_5_1 like Mac OS X;)',
-                    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-                    'Accept-Language': 'en-US,en;q=0.5',
-                },
-            }
-            
-            if media_type == 'audio':
-                # For audio: extract best audio, convert to mp3
-                ydl_opts.update({
-                    'format': 'bestaudio/best',
-                    'postprocessors': [{
-                        'key': 'FFmpegExtractAudio',
-                        'preferredcodec': 'mp3',
-                        'preferredquality': '192',
-                    }],
-                })
+
+            ydl_opts = _BASE_YDL_OPTS.copy()
+            if media_type == 'audio-mp3':
+                ydl_opts.update(_AUDIO_MP3_YDL_OPTS)
+            elif media_type == 'audio':
+                ydl_opts.update(_AUDIO_YDL_OPTS)
             else:
-                # For video: Use format that ios client actually provides
-                # The ios client returns HLS streams, so we need to let yt-dlp handle it
-                ydl_opts.update({
-                    # Don't specify format - let yt-dlp pick the best available
-                    'format': None,  # This tells yt-dlp to use default (best)
-                    'merge_output_format': 'mp4',
-                    'postprocessors': [{
-                        'key': 'FFmpegVideoConvertor',
-                        'preferedformat': 'mp4',
-                    }],
-                })
-            
-            # Download the media
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                logger.info(f"🔄 Extracting info for: {url}")
-                info = ydl.extract_info(url, download=True)
-                
-                if info is None:
-                    raise Exception("Failed to extract video info")
-                
-                title = info.get('title', 'Unknown')
-                duration = info.get('duration', 0)
-                video_id = info.get('id', 'unknown')
-                
-                logger.info(f"✅ Downloaded: {title} ({duration}s)")
-                
-                # Find the downloaded file
+                ydl_opts.update(_VIDEO_YDL_OPTS)
+            ydl_opts['outtmpl'] = output_template
+            if PROXY_URL:
+                ydl_opts['proxy'] = _proxy_with_session(PROXY_URL)
+
+            # A recent job for the same video (typically a retry after an
+            # upload failure) left its extractor result in the cache; start
+            # from that and skip the extraction round trips entirely
+            cache_key = _normalize_info_url(url)
+            with DL_INFO_CACHE_LOCK:
+                cached = DL_INFO_CACHE.get(cache_key)
+            info = copy.deepcopy(cached[1]) if cached and cached[0] > time.monotonic() else None
+
+            # Download the media. The ios client alone answers almost every
+            # public video; when it can't, retry once with mweb added rather
+            # than paying the second Innertube handshake on every job.
+            for clients in (['ios'], ['ios', 'mweb']):
+                ydl_opts['extractor_args'] = {
+                    'youtube': {'player_client': clients, 'player_skip': ['webpage', 'configs']}
+                }
+                try:
+                    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                        if info is None:
+                            logger.info(f"🔄 Extracting info for: {url} via {clients}")
+                            info = _extract_with_backoff(ydl, url, download=False)
+
+                            if info is None:
+                                raise Exception("Failed to extract video info")
+
+                            with DL_INFO_CACHE_LOCK:
+                                if len(DL_INFO_CACHE) >= DL_INFO_CACHE_MAX:
+                                    DL_INFO_CACHE.clear()
+                                DL_INFO_CACHE[cache_key] = (
+                                    time.monotonic() + DL_INFO_CACHE_TTL,
+                                    copy.deepcopy(info),
+                                )
+
+                        # The probe above was metadata-only, so oversize
+                        # assets can be refused here before a single media
+                        # byte is fetched
+                        duration = info.get('duration') or 0
+                        filesize = info.get('filesize_approx') or info.get('filesize') or 0
+                        if MAX_DURATION_SECONDS and duration > MAX_DURATION_SECONDS:
+                            raise Exception(f"Asset too long: {duration}s exceeds the {MAX_DURATION_SECONDS}s cap")
+                        if MAX_FILESIZE_BYTES and filesize > MAX_FILESIZE_BYTES:
+                            raise Exception(f"Asset too large: ~{filesize} bytes exceeds the {MAX_FILESIZE_BYTES} byte cap")
+
+                        # Run the actual download from the (possibly cached)
+                        # info dict; process_ie_result mutates info in place,
+                        # which is why the cache holds its own copy
+                        info = ydl.process_ie_result(info, download=True)
+
+                        logger.info(f"✅ Downloaded: {info.get('title', 'Unknown')} ({info.get('duration', 0)}s)")
+
+                        # yt-dlp reports the final output path (post-processors
+                        # update it in place; when several downloads are
+                        # requested the processed output is the last entry), so
+                        # we don't need to scan the temp dir
+                        requested = info.get('requested_downloads') or [{}]
+                        downloaded_file = requested[-1].get('filepath') or ydl.prepare_filename(info)
+                    break
+                except yt_dlp.utils.DownloadError as e:
+                    if len(clients) > 1:
+                        raise
+                    # Cached format URLs may simply have gone stale; drop them
+                    # and re-extract fresh with the fallback client list
+                    info = None
+                    with DL_INFO_CACHE_LOCK:
+                        DL_INFO_CACHE.pop(cache_key, None)
+                    logger.warning(f"⚠️ ios client failed, retrying with mweb: {e}")
+
+            # Safety net in case an old yt-dlp doesn't report the path;
+            # scandir gives us the name, path and a cached stat per entry
+            # without the extra syscalls of listdir + getsize
+            file_size = None
+            if not downloaded_file or not os.path.exists(downloaded_file):
                 downloaded_file = None
-                expected_ext = 'mp3' if media_type == 'audio' else 'mp4'
-                
-                for file in os.listdir(temp_dir):
-                    if file.endswith(f'.{expected_ext}'):
-                        downloaded_file = os.path.join(temp_dir, file)
-                        break
-                
-                # If mp4 not found, look for any video file
-                if not downloaded_file:
-                    for file in os.listdir(temp_dir):
-                        if file.endswith(('.mp4', '.mkv', '.webm', '.m4a', '.mp3')):
-                            downloaded_file = os.path.join(temp_dir, file)
+                with os.scandir(temp_dir) as it:
+                    for entry in it:
+                        if entry.name.endswith(('.mp4', '.mkv', '.webm', '.m4a', '.mp3')) and entry.is_file():
+                            downloaded_file = entry.path
+                            file_size = entry.stat().st_size
                             break
-                
-                if not downloaded_file:
-                    files_in_dir = os.listdir(temp_dir)
-                    logger.error(f"❌ No output file found. Files in temp dir: {files_in_dir}")
-                    raise Exception(f"Download completed but no output file found. Files: {files_in_dir}")
-                
+
+            if not downloaded_file:
+                files_in_dir = os.listdir(temp_dir)
+                logger.error(f"❌ No output file found. Files in temp dir: {files_in_dir}")
+                raise Exception(f"Download completed but no output file found. Files: {files_in_dir}")
+
+            if file_size is None:
                 file_size = os.path.getsize(downloaded_file)
-                logger.info(f"📁 Output file: {downloaded_file} ({file_size} bytes)")
-                
-                # Upload to Supabase Storage using signed URL
-                if upload_url:
-                    logger.info(f"☁️ Uploading to Supabase Storage...")
-                    with open(downloaded_file, 'rb') as f:
-                        upload_response = requests.put(
-                            upload_url,
-                            data=f,
-                            headers={'Content-Type': content_type}
-                        )
-                        
-                        if upload_response.status_code not in [200, 201]:
-                            logger.error(f"❌ Upload failed: {upload_response.status_code} - {upload_response.text}")
-                            raise Exception(f"Failed to upload to storage: {upload_response.status_code}")
-                        
-                        logger.info(f"✅ Upload successful!")
-                
-                # Send success callback
-                callback_data = {
-                    'asset_id': asset_id,
-                    'status': 'ready',
-                    'title': title,
-                    'duration_seconds': duration,
-                    'asset_url': public_url,
-                    'secret': data['secret'],
-                }
-                
-                logger.info(f"📞 Sending callback to: {callback_url}")
-                callback_response = requests.post(callback_url, json=callback_data, timeout=30)
-                logger.info(f"✅ Callback response: {callback_response.status_code}")
-                
-                return jsonify({
-                    "success": True,
-                    "title": title,
-                    "duration": duration,
-                    "asset_id": asset_id
-                })
-                
+            logger.info(f"📁 Output file: {downloaded_file} ({file_size} bytes)")
+
+            UPLOAD_EXECUTOR.submit(_finish_job, data, info, temp_dir, downloaded_file, file_size)
+            handed_off = True
+        finally:
+            if not handed_off:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+
     except Exception as e:
         error_msg = str(e)
-        logger.error(f"❌ Error: {error_msg}")
-        
-        # Send failure callback
-        if 'callback_url' in data and 'asset_id' in data:
-            try:
-                callback_data = {
-                    'asset_id': data['asset_id'],
-                    'status': 'failed',
-                    'error_message': error_msg,
-                    'secret': data.get('secret', ''),
-                }
-                requests.post(data['callback_url'], json=callback_data, timeout=10)
-            except Exception as callback_error:
-                logger.error(f"❌ Callback error: {callback_error}")
-        
-        return jsonify({"error": error_msg}), 500
+        # logger.exception formats the traceback lazily, only when a handler
+        # actually consumes the record
+        logger.exception(f"❌ Download failed: {error_msg}")
+        _send_failure(data, error_msg)
+    finally:
+        if not handed_off:
+            INFLIGHT.release()
+
+def _finish_job(data, info, temp_dir, downloaded_file, file_size):
+    """Upload stage: ship the downloaded file to storage and fire the
+    callback, then clean up the scratch dir and free the job slot."""
+    try:
+        upload_url = data.get('upload_url')
+        public_url = data.get('public_url')
+        if not public_url and upload_url:
+            public_url = _public_url_from_signed(upload_url)
+        file_ext = os.path.splitext(downloaded_file)[1].lower()
+        content_type = data.get('content_type') or _MIME_BY_EXT.get(file_ext, 'application/octet-stream')
+
+        # Upload to Supabase Storage using signed URL
+        if upload_url:
+            logger.info(f"☁️ Uploading to Supabase Storage...")
+            result = None
+            if file_size > RESUMABLE_THRESHOLD:
+                result = _upload_resumable(upload_url, downloaded_file, file_size, content_type)
+            if result is None:
+                result = _put_file(upload_url, downloaded_file, file_size, content_type)
+            status, body = result
+
+            if status not in [200, 201]:
+                logger.error(f"❌ Upload failed: {status} - {body}")
+                raise Exception(f"Failed to upload to storage: {status}")
+
+            logger.info(f"✅ Upload successful!")
+
+        # Send success callback
+        callback_data = {
+            'asset_id': data['asset_id'],
+            'status': 'ready',
+            'title': info.get('title', 'Unknown'),
+            'duration_seconds': info.get('duration', 0),
+            'asset_url': public_url,
+            # Pass the thumbnail by URL - fetching it here would block
+            # the job for bytes the consumer can pull itself
+            'thumbnail_url': info.get('thumbnail'),
+            'secret': data['secret'],
+        }
+
+        _send_callback(data['callback_url'], callback_data)
+
+    except Exception as e:
+        error_msg = str(e)
+        logger.exception(f"❌ Upload failed: {error_msg}")
+        _send_failure(data, error_msg)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        INFLIGHT.release()
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 8080))
@@ -0,0 +1,10 @@
+import os
+
+# gthread workers: handlers either answer instantly (/health, 202 enqueue) or
+# wait on network I/O (/info), so a few threads per worker go a long way.
+# The heavy yt-dlp/ffmpeg work runs on the app's own pool, not these threads.
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', '2'))
+threads = int(os.environ.get('THREADS', '8'))
+worker_class = 'gthread'
+timeout = 900